@@ -23,24 +23,42 @@
 
 import argparse
 import asyncio
+import collections
 import datetime
-import json
 import logging
 import pathlib
 import signal
+import socket
 import sys
+
+import orjson
 import websockets
 
 from python_banyan.banyan_base_aio import BanyanBaseAIO
 
+# uvloop is optional - use it if it is installed (not available on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 class NrWsGateway(BanyanBaseAIO):
     """
     This class is a gateway between a node-red websocket client and the
     Banyan network.
 
+    Messages are JSON on the websocket side and msgpack on the Banyan side.
+    Each message is translated once: in receive_data for messages from
+    node-red, and in flush_outgoing for messages to node-red.
     """
 
+    # maximum number of messages sent in a single websocket frame
+    MAX_BATCH = 64
+
+    # time in seconds to wait for a burst of messages to accumulate
+    BATCH_WINDOW = .001
+
     def __init__(self, subscription_list, back_plane_ip_address=None,
                  subscriber_port='43125',
                  publisher_port='43124', process_name='nr_pb_Gateway',
@@ -69,7 +87,10 @@ class NrWsGateway(BanyanBaseAIO):
         # a kludge to shut down the socket on control C
         self.wsocket = None
 
-        self.publisher_topic = None
+        # topic used to publish client messages to the arduino gateway,
+        # and its encoded form so that it is not re-encoded for every message
+        self.publisher_topic = 'to_arduino_gateway'
+        self._publisher_topic_b = self.publisher_topic.encode()
 
         if self.log:
             fn = str(pathlib.Path.home()) + "/nrpbgw.log"
@@ -90,35 +111,65 @@ class NrWsGateway(BanyanBaseAIO):
 
         # array of active sockets
         self.active_sockets = []
+
+        # outgoing payloads waiting to be sent to the node-red client
+        self._send_deque = collections.deque()
+
+        # future used to wake up flush_outgoing when the deque was empty
+        self._send_wake = None
+
+        # task that batches queued payloads into websocket frames
+        self._flush_task = None
         try:
+            # node-red messages are small, so per-message compression
+            # costs CPU without saving any bytes. The server declines
+            # permessage-deflate if a client offers it.
+            # Keepalive pings are disabled, and the buffer limits are sized
+            # for bursts of small messages.
             self.start_server = websockets.serve(self.wsg,
                                                  '0.0.0.0',
-                                                 self.server_ip_port)
+                                                 self.server_ip_port,
+                                                 compression=None,
+                                                 max_size=2 ** 16,
+                                                 ping_interval=None,
+                                                 read_limit=2 ** 16,
+                                                 write_limit=2 ** 20)
             print('WebSocket using: ' + self.back_plane_ip_address
                   + ':' + self.server_ip_port)
             # start the websocket server and call the main task, wsg
             self.event_loop.run_until_complete(self.start_server)
-            self.event_loop.create_task(self.wakeup())
+
+            # shut down cleanly on a signal. Windows does not support
+            # loop signal handlers and relies on the module's signal_handler.
+            if sys.platform != 'win32':
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    self.event_loop.add_signal_handler(sig, self.shutdown)
+
             self.event_loop.run_forever()
         except (websockets.exceptions.ConnectionClosed,
                 RuntimeError,
                 KeyboardInterrupt):
             if self.log:
                 logging.exception("Exception occurred", exc_info=True)
-            self.event_loop.stop()
-            self.event_loop.close()
+        # the loop is no longer running here, so it is not stopped first -
+        # that would end the run that cancels the pending tasks at once
+        cancel_all_tasks(self.event_loop)
+        self.event_loop.close()
 
-    async def wakeup(self):
-        while True:
-            try:
-                await asyncio.sleep(1)
-            except KeyboardInterrupt:
-                for task in asyncio.Task.all_tasks():
-                    task.cancel()
-                await self.wsocket.close()
-                self.event_loop.stop()
-                self.event_loop.close()
-                sys.exit(0)
+    def shutdown(self):
+        """
+        Signal handler for SIGINT and SIGTERM
+        """
+        self.event_loop.create_task(self.close_down())
+
+    async def close_down(self):
+        """
+        Close the client websocket and stop the event loop.
+        The remaining tasks are cancelled once the loop has stopped.
+        """
+        if self.wsocket:
+            await self.wsocket.close()
+        self.event_loop.stop()
 
     async def wsg(self, websocket, _path):
         """
@@ -129,18 +180,27 @@ class NrWsGateway(BanyanBaseAIO):
         """
         data = None
         self.wsocket = websocket
-        self.publisher_topic = "to_arduino_gateway"
+
+        # node-red messages are small, so make sure that Nagle's algorithm
+        # does not delay them. asyncio and uvloop normally do this already.
+        sock = websocket.transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         # start up banyan
         await self.begin()
 
+        # start the task that sends banyan messages to the client
+        if not self._flush_task:
+            self._flush_task = self.event_loop.create_task(self.flush_outgoing())
+
         # wait for a connection
         # try:
         #     data = await websocket.recv()
         # except websockets.exceptions.ConnectionClosedOK:
         #     pass
 
-        # create a task to receive messages from the client
-        await asyncio.create_task(self.receive_data(websocket))
+        # receive messages from the client
+        await self.receive_data(websocket)
 
         # create the banyan receive loop
         # await self.start_the_receive_loop()
@@ -151,31 +211,90 @@ class NrWsGateway(BanyanBaseAIO):
         and translates it to a Banyan command message.
         :param websocket: The currently active websocket
         """
+        topic = self._publisher_topic_b
+        publisher = self.publisher
         while True:
             try:
                 data = await websocket.recv()
 
-                data = json.loads(data)
+                # orjson accepts the frame as received, str or bytes,
+                # without a separate encode step
+                data = orjson.loads(data)
                 pub_data = data['payload']
             except (websockets.exceptions.ConnectionClosed, TypeError):
                 break
-            print(f'pub_data = {pub_data}')
-            await self.publish_payload(pub_data, self.publisher_topic)
+            if self.log:
+                self.logger.debug('pub_data = %s', pub_data)
+            message = await self.pack(pub_data)
+            await publisher.send_multipart([topic, message])
 
     async def incoming_message_processing(self, topic, payload):
         """
-        This method converts the incoming messages to ws messages
-        and sends them to the ws client
+        This method queues the incoming messages to be sent
+        to the ws client by flush_outgoing
 
         :param topic: Message Topic string.
 
         :param payload: Message Data.
         """
-        x = {'payload': payload}
-        ws_data = json.dumps(x)
-        print(x)
+        if self.log:
+            self.logger.debug('payload = %s', payload)
+
+        # the arduino gateway coalesces bursts of reports as
+        # {'reports': [report, report, ...]}
+        if 'reports' in payload:
+            self._send_deque.extend(payload['reports'])
+        else:
+            self._send_deque.append(payload)
+        if self._send_wake and not self._send_wake.done():
+            self._send_wake.set_result(None)
+
+    async def flush_outgoing(self):
+        """
+        This method converts the queued messages to ws messages
+        and sends them to the ws client.
+
+        A single message is sent as {'payload': payload}. When several
+        messages arrive in a burst, up to MAX_BATCH of them are sent in
+        one frame as {'payload': [payload, payload, ...]}.
+        """
+        send_deque = self._send_deque
+        while True:
+            if not send_deque:
+                # sleep until incoming_message_processing has work for us
+                self._send_wake = self.event_loop.create_future()
+                await self._send_wake
+                self._send_wake = None
 
-        await self.wsocket.send(ws_data)
+                # allow a burst of messages to accumulate
+                await asyncio.sleep(self.BATCH_WINDOW)
+
+            batch = [send_deque.popleft()
+                     for _ in range(min(len(send_deque), self.MAX_BATCH))]
+
+            # non-string keys are converted to strings, as json.dumps does
+            try:
+                if len(batch) == 1:
+                    payload = orjson.dumps(batch[0], option=orjson.OPT_NON_STR_KEYS)
+                else:
+                    payload = orjson.dumps(batch, option=orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                # a payload that cannot be encoded - drop the batch
+                if self.log:
+                    self.logger.exception('unable to encode batch = %s', batch)
+                continue
+
+            # wrap the encoded payload as {"payload": ...} without building
+            # an envelope dictionary.
+            # orjson produces bytes, which are sent as a binary frame.
+            # node-red's websocket node parses binary frames the same as text
+            # when "send/receive entire message" is selected.
+            ws_data = b'{"payload":' + payload + b'}'
+            try:
+                await self.wsocket.send(ws_data)
+            except websockets.exceptions.ConnectionClosed:
+                # the client went away - drop the batch
+                continue
 
     def my_handler(self, _the_type, _value, _tb):
         """
@@ -188,6 +307,20 @@ class NrWsGateway(BanyanBaseAIO):
         self.logger.exception("Uncaught exception: {0}".format(str(value)))
 
 
+def cancel_all_tasks(loop):
+    """
+    Cancel all of the tasks of a stopped event loop and wait for
+    them to finish before the loop is closed.
+    :param loop: asyncio event loop
+    """
+    tasks = asyncio.all_tasks(loop)
+    if not tasks:
+        return
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
 def nr_ws_gateway():
     # allow user to bypass the IP address auto-discovery. This is necessary if the component resides on a computer
     # other than the computing running the backplane.
@@ -203,8 +336,9 @@ def nr_ws_gateway():
                         help="OptionalAsyncio event loop")
     parser.add_argument("-i", dest="server_ip_port", default="9000",
                         help="Set the WebSocket Server IP Port number")
-    parser.add_argument("-l", dest="log", default="False",
-                        help="Set to True to turn logging on.")
+    parser.add_argument("-l", "--log", dest="log", default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help="Turn logging on.")
     parser.add_argument("-n", dest="process_name", default="NodeRed WebSocket Gateway",
                         help="Set process name in banner")
     parser.add_argument("-p", dest="publisher_port", default='43124',
@@ -228,12 +362,7 @@ def nr_ws_gateway():
         'server_ip_port': args.server_ip_port,
     }
 
-    log = args.log.lower()
-    if log == 'false':
-        log = False
-    else:
-        log = True
-    kw_options['log'] = log
+    kw_options['log'] = args.log
 
     if args.back_plane_ip_address != 'None':
         kw_options['back_plane_ip_address'] = args.back_plane_ip_address
@@ -244,17 +373,16 @@ def nr_ws_gateway():
     # this is for python 3.8
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    elif uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
     # loop = asyncio.new_event_loop()
     # asyncio.set_event_loop(loop)
 
+    # NrWsGateway cancels its tasks and closes its event loop on exit
     try:
         NrWsGateway(subscription_list, **kw_options)
     except KeyboardInterrupt:
-        for task in asyncio.Task.all_tasks():
-            task.cancel()
-        loop.stop()
-        loop.close()
         sys.exit(0)
 
 
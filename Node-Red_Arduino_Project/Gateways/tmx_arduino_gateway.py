@@ -18,20 +18,63 @@
 import argparse
 import asyncio
 import logging
+import operator
 import pathlib
 import signal
 import sys
 
+import msgpack
 from telemetrix_aio import telemetrix_aio
 from python_banyan.gateway_base_aio import GatewayBaseAIO
 
+# uvloop is optional - use it if it is installed (not available on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# payload field getters for the command handlers.
+# each one fetches all of the fields that a handler needs in a single call.
+_PIN_VALUE = operator.itemgetter('pin', 'value')
+_I2C_READ_FIELDS = operator.itemgetter('addr', 'register', 'number_of_bytes')
+_I2C_WRITE_FIELDS = operator.itemgetter('addr', 'data')
+_TONE_FIELDS = operator.itemgetter('pin', 'freq', 'duration')
+_SERVO_FIELDS = operator.itemgetter('pin', 'position')
+_SONAR_FIELDS = operator.itemgetter('trigger_pin', 'echo_pin')
+_STEPPER_MODE_FIELDS = operator.itemgetter('steps_per_revolution', 'pins')
+_STEPPER_WRITE_FIELDS = operator.itemgetter('motor_speed', 'number_of_steps')
+
+# msgpack encodings of the constant parts of the digital and analog
+# input reports. At run time only the pin, value and timestamp are packed,
+# and the result is byte for byte what packing the report dictionary
+# would produce.
+_packer = msgpack.Packer(use_bin_type=True)
+
+
+def _input_report_prefix(report):
+    return b''.join((_packer.pack_map_header(4),
+                     _packer.pack('report'), _packer.pack(report),
+                     _packer.pack('pin')))
+
+
+_DIGITAL_PREFIX = _input_report_prefix('digital_input')
+_ANALOG_PREFIX = _input_report_prefix('analog_input')
+_VALUE_KEY = _packer.pack('value')
+_TIMESTAMP_KEY = _packer.pack('timestamp')
+
+# start of a coalesced {'reports': [report, report, ...]} message
+_REPORTS_PREFIX = _packer.pack_map_header(1) + _packer.pack('reports')
 
 # noinspection PyAbstractClass,PyMethodMayBeStatic,PyRedundantParentheses,DuplicatedCode
 class TmxArduinoGateway(GatewayBaseAIO):
     # This class implements the GatewayBase interface adapted for asyncio.
     # It supports Arduino boards, tested with Uno.
 
-    # NOTE: This class requires the use of Python 3.7 or above
+    # NOTE: This class requires the use of Python 3.9 or above
+
+    # time in seconds that reports are held so that a burst of reports
+    # is published as a single message
+    REPORT_WINDOW = .001
 
     # serial_port = None
 
@@ -68,24 +111,35 @@ class TmxArduinoGateway(GatewayBaseAIO):
         # set the event loop to be used. accept user's if provided
         self.event_loop = event_loop
 
-        # instantiate telemetrix-aio to control the arduino
+        # instantiate telemetrix-aio to control the arduino.
+        # telemetrix-aio owns the serial reader and hands each report to
+        # the callbacks below as a new list. The callbacks copy the values
+        # they need into a new payload and never keep a reference to it.
+        tmx_options = {'loop': self.event_loop}
+
         # if user want to pass in a com port, then pass it in
+        if com_port:
+            tmx_options['com_port'] = com_port
+        # if user wants to set an instance id, then pass it in
+        elif arduino_instance_id:
+            tmx_options['arduino_instance_id'] = arduino_instance_id
+
         try:
-            if com_port:
-                self.arduino = TelemetrixAIO(loop=self.event_loop,
-                                             com_port=com_port)
-            # if user wants to set an instance id, then pass it in
-            elif arduino_instance_id:
-                self.arduino = telemetrix_aio.TelemetrixAIO(loop=self.event_loop,
-                                             arduino_instance_id=arduino_instance_id)
-            # default settings
-            else:
-                self.arduino = telemetrix_aio.TelemetrixAIO(loop=self.event_loop)
+            self.arduino = telemetrix_aio.TelemetrixAIO(**tmx_options)
         except RuntimeError:
             if self.log:
                 logging.exception("Exception occurred", exc_info=True)
             raise
 
+        # topic for reports sent from the arduino, and its encoded form
+        # so that it is not re-encoded for every report
+        self._topic_from_arduino = 'from_arduino_gateway'
+        self._topic_from_arduino_b = self._topic_from_arduino.encode()
+
+        # encoded reports waiting to be published by flush_reports
+        self._pending_reports = []
+        self._flush_scheduled = False
+
         # set number of pins to a fixed value
         self.number_of_digital_pins = 100
         # self.number_of_analog_pins = 100
@@ -100,6 +154,11 @@ class TmxArduinoGateway(GatewayBaseAIO):
                                                 process_name=process_name,
                                                 )
 
+        # the parent maps the enable reporting commands to the
+        # disable reporting handlers, so point them at the right ones
+        self.command_dictionary['enable_analog_reporting'] = self.enable_analog_reporting
+        self.command_dictionary['enable_digital_reporting'] = self.enable_digital_reporting
+
     # noinspection PyUnreachableCode
     def init_pins_dictionary(self):
         """
@@ -122,6 +181,47 @@ class TmxArduinoGateway(GatewayBaseAIO):
         while True:
             await self.receive_loop()
 
+    async def incoming_message_processing(self, topic, payload):
+        """
+        Messages are sent here from the receive_loop.
+        This overrides the gateway base method to accept batched
+        commands and to look up each command handler only once.
+
+        :param topic: Message Topic string
+
+        :param payload: Message Data
+        """
+        # pin_init may send a batch of commands as {'commands': [...]}
+        if 'commands' in payload:
+            for command_payload in payload['commands']:
+                await self.incoming_message_processing(topic, command_payload)
+            return
+
+        # process payload command
+        try:
+            command = payload['command']
+        except KeyError:
+            print('incoming_message_processed KeyError', payload)
+            raise
+
+        # if a tag is provided and the tag is in the dictionary, fetch
+        # the associated pin number
+        if 'tag' in payload:
+            tag = payload['tag']
+            if tag:
+                if tag in self.tags_dictionary:
+                    # the pin is optional if using tag, so add it to the payload
+                    payload['pin'] = self.tags_dictionary[tag]
+                else:
+                    self.tags_dictionary[tag] = payload['pin']
+
+        handler = self.command_dictionary.get(command)
+        if handler:
+            await handler(topic, payload)
+        # for unknown requests, pass them along to the gateway base
+        else:
+            await self.additional_banyan_messages(topic, payload)
+
     # The following methods and are called
     # by the gateway base class in its incoming_message_processing
     # method. They overwrite the default methods in the gateway_base.
@@ -132,7 +232,8 @@ class TmxArduinoGateway(GatewayBaseAIO):
         :param topic: message topic
         :param payload: {"command": "digital_write", "pin": “PIN”, "value": “VALUE”}
         """
-        await self.arduino.digital_write(payload["pin"], payload['value'])
+        pin, value = _PIN_VALUE(payload)
+        await self.arduino.digital_write(pin, value)
 
     async def disable_analog_reporting(self, topic, payload):
         """
@@ -181,10 +282,8 @@ class TmxArduinoGateway(GatewayBaseAIO):
                          "number_of_bytes": “NUMBER OF BYTES”}
         :return via the i2c_callback method
         """
-
-        await self.arduino.i2c_read(payload['addr'],
-                                    payload['register'],
-                                    payload['number_of_bytes'],
+        addr, register, number_of_bytes = _I2C_READ_FIELDS(payload)
+        await self.arduino.i2c_read(addr, register, number_of_bytes,
                                     callback=self.i2c_callback)
 
     async def i2c_write(self, topic, payload):
@@ -200,7 +299,8 @@ class TmxArduinoGateway(GatewayBaseAIO):
                          "addr": “I2C ADDRESS, "register": “I2C REGISTER”,
                          "data": [“DATA IN LIST FORM”]}
         """
-        await self.arduino.i2c_write(payload['addr'], payload['data'])
+        addr, data = _I2C_WRITE_FIELDS(payload)
+        await self.arduino.i2c_write(addr, data)
 
     async def play_tone(self, topic, payload):
         """
@@ -213,9 +313,8 @@ class TmxArduinoGateway(GatewayBaseAIO):
         :param payload: {"command": "play_tone", "pin": “PIN”, "tag": "TAG",
                          “freq”: ”FREQUENCY”, duration: “DURATION”}
         """
-        await self.arduino.play_tone(payload['pin'],
-                                     payload['freq'],
-                                     payload['duration'])
+        pin, freq, duration = _TONE_FIELDS(payload)
+        await self.arduino.play_tone(pin, freq, duration)
 
     async def pwm_write(self, topic, payload):
         """
@@ -226,7 +325,8 @@ class TmxArduinoGateway(GatewayBaseAIO):
                          "tag":”TAG”,
                           “value”: “VALUE”}
         """
-        await self.arduino.analog_write(payload["pin"], payload['value'])
+        pin, value = _PIN_VALUE(payload)
+        await self.arduino.analog_write(pin, value)
 
     async def servo_position(self, topic, payload):
         """
@@ -239,7 +339,8 @@ class TmxArduinoGateway(GatewayBaseAIO):
                          "pin": “PIN”,'tag': 'servo',
                         “position”: “POSITION”}
         """
-        await self.arduino.servo_write(payload["pin"], payload["position"])
+        pin, position = _SERVO_FIELDS(payload)
+        await self.arduino.servo_write(pin, position)
 
     async def set_mode_analog_input(self, topic, payload):
         """
@@ -317,9 +418,7 @@ class TmxArduinoGateway(GatewayBaseAIO):
         :param payload: {"command": "set_mode_sonar", "trigger_pin": “PIN”, "tag":”TAG”
                          "echo_pin": “PIN”"tag":”TAG” }
         """
-
-        trigger = payload["trigger_pin"]
-        echo = payload["echo_pin"]
+        trigger, echo = _SONAR_FIELDS(payload)
 
         await self.arduino.set_pin_mode_sonar(trigger, echo, callback=self.sonar_callback)
 
@@ -331,9 +430,8 @@ class TmxArduinoGateway(GatewayBaseAIO):
         :param payload:{"command": "set_mode_stepper", "pins": [“PINS”],
                         "steps_per_revolution": “NUMBER OF STEPS”}
         """
-
-        await self.arduino.set_pin_mode_stepper(payload['steps_per_revolution'],
-                                                payload['pins'])
+        steps_per_revolution, pins = _STEPPER_MODE_FIELDS(payload)
+        await self.arduino.set_pin_mode_stepper(steps_per_revolution, pins)
 
     async def set_mode_tone(self, topic, payload):
         """
@@ -351,8 +449,8 @@ class TmxArduinoGateway(GatewayBaseAIO):
         :param payload: {"command": "stepper_write", "motor_speed": “SPEED”,
                          "number_of_steps": ”NUMBER OF STEPS” }
         """
-        await self.arduino.stepper_write(payload['motor_speed'],
-                                         payload['number_of_steps'])
+        motor_speed, number_of_steps = _STEPPER_WRITE_FIELDS(payload)
+        await self.arduino.stepper_write(motor_speed, number_of_steps)
 
     # Callbacks
     async def digital_input_callback(self, data):
@@ -362,15 +460,23 @@ class TmxArduinoGateway(GatewayBaseAIO):
         :return:
         """
         # data = [pin mode, pin, current reported value, timestamp]
-        payload = {'report': 'digital_input', 'pin': data[1],
-                   'value': data[2], 'timestamp': data[3]}
-        await self.publish_payload(payload, 'from_arduino_gateway')
+        # message = {'report': 'digital_input', 'pin': data[1],
+        #            'value': data[2], 'timestamp': data[3]}
+        pack = _packer.pack
+        message = b''.join((_DIGITAL_PREFIX, pack(data[1]),
+                            _VALUE_KEY, pack(data[2]),
+                            _TIMESTAMP_KEY, pack(data[3])))
+        self.queue_report(message)
 
     async def analog_input_callback(self, data):
         # data = [pin mode, pin, current reported value, timestamp]
-        payload = {'report': 'analog_input', 'pin': data[1],
-                   'value': data[2], 'timestamp': data[3]}
-        await self.publish_payload(payload, 'from_arduino_gateway')
+        # message = {'report': 'analog_input', 'pin': data[1],
+        #            'value': data[2], 'timestamp': data[3]}
+        pack = _packer.pack
+        message = b''.join((_ANALOG_PREFIX, pack(data[1]),
+                            _VALUE_KEY, pack(data[2]),
+                            _TIMESTAMP_KEY, pack(data[3])))
+        self.queue_report(message)
 
     async def i2c_callback(self, data):
         """
@@ -379,10 +485,12 @@ class TmxArduinoGateway(GatewayBaseAIO):
         :param data:
         :return:
         """
-        # creat a string representation of the data returned
-        report = ', '.join([str(elem) for elem in data])
+        # create a string representation of the data returned.
+        # data is a list of ints ending with a float timestamp,
+        # so bytes.hex() cannot be used here.
+        report = ', '.join(map(str, data))
         payload = {'report': 'i2c_data', 'value': report}
-        await self.publish_payload(payload, 'from_arduino_gateway')
+        await self.publish_report(payload)
 
     async def sonar_callback(self, data):
         """
@@ -392,7 +500,49 @@ class TmxArduinoGateway(GatewayBaseAIO):
         :return:
         """
         payload = {'report': 'sonar_data', 'value': data[2]}
-        await self.publish_payload(payload, 'from_arduino_gateway')
+        await self.publish_report(payload)
+
+    async def publish_report(self, payload):
+        """
+        Publish a report using the pre-encoded report topic.
+        This is equivalent to publish_payload(payload, 'from_arduino_gateway')
+        :param payload: report payload
+        """
+        message = await self.pack(payload)
+        self.queue_report(message)
+
+    def queue_report(self, message):
+        """
+        Queue an already msgpack encoded report to be published
+        by flush_reports.
+        :param message: msgpack encoded report
+        """
+        self._pending_reports.append(message)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.event_loop.create_task(self.flush_reports())
+
+    async def flush_reports(self):
+        """
+        Publish the reports queued within REPORT_WINDOW seconds using the
+        pre-encoded report topic.
+
+        A single report is published as is. Several reports are published
+        as one message: {'reports': [report, report, ...]}
+        """
+        await asyncio.sleep(self.REPORT_WINDOW)
+
+        reports = self._pending_reports
+        self._pending_reports = []
+        self._flush_scheduled = False
+
+        if len(reports) == 1:
+            message = reports[0]
+        else:
+            message = b''.join((_REPORTS_PREFIX,
+                                _packer.pack_array_header(len(reports)),
+                                *reports))
+        await self.publisher.send_multipart([self._topic_from_arduino_b, message])
 
     def my_handler(self, _tp, value, _tb):
         """
@@ -405,6 +555,20 @@ class TmxArduinoGateway(GatewayBaseAIO):
         self.logger.exception("Uncaught exception: {0}".format(str(value)))
 
 
+def cancel_all_tasks(loop):
+    """
+    Cancel all of the tasks of a stopped event loop and wait for
+    them to finish before the loop is closed.
+    :param loop: asyncio event loop
+    """
+    tasks = asyncio.all_tasks(loop)
+    if not tasks:
+        return
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
 # noinspection DuplicatedCode
 def tmx_arduino_gateway():
     # allow user to bypass the IP address auto-discovery. This is necessary if the component resides on a computer
@@ -418,8 +582,9 @@ def tmx_arduino_gateway():
     parser.add_argument("-i", dest="arduino_instance_id", default="None",
                         help="Set an Arduino Instance ID and match it in "
                              "Telemetrix4Arduino")
-    parser.add_argument("-l", dest="log", default="False",
-                        help="Set to True to turn logging on.")
+    parser.add_argument("-l", "--log", dest="log", default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help="Turn logging on.")
     parser.add_argument("-m", dest="subscriber_list",
                         default="to_arduino_gateway", nargs='+',
                         help="Banyan topics space delimited: topic1 topic2 topic3")
@@ -443,13 +608,7 @@ def tmx_arduino_gateway():
         'process_name': args.process_name,
     }
 
-    log = args.log.lower()
-    if log == 'false':
-        log = False
-    else:
-        log = True
-
-    kw_options['log'] = log
+    kw_options['log'] = args.log
 
     if args.back_plane_ip_address != 'None':
         kw_options['back_plane_ip_address'] = args.back_plane_ip_address
@@ -464,6 +623,8 @@ def tmx_arduino_gateway():
     # this is for python 3.8
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    elif uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
     # get the event loop
     loop = asyncio.new_event_loop()
@@ -476,9 +637,13 @@ def tmx_arduino_gateway():
     except (KeyboardInterrupt, asyncio.CancelledError, RuntimeError):
         if app.log:
             logging.exception("Exception occurred", exc_info=True)
-        loop.stop()
-        loop.close()
         sys.exit(0)
+    finally:
+        # also reached when the signal handler exits with SystemExit.
+        # The loop is no longer running here, so it is not stopped first -
+        # that would end the run that cancels the pending tasks at once.
+        cancel_all_tasks(loop)
+        loop.close()
 
 
 # signal handler function called when Control-C occurs
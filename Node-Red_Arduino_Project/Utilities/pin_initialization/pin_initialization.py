@@ -17,7 +17,12 @@
 
 """
 
+import argparse
+import signal
 import sys
+import time
+
+import msgpack
 from python_banyan.banyan_base import BanyanBase
 
 
@@ -26,11 +31,20 @@ class PinInit(BanyanBase):
     This class subscribes to receive messages to issue OneGPIO messages to set pin modes.
     """
 
-    def __init__(self, publisher_topic='to_arduino_gateway', subscription_topic='pin_init'):
+    # seconds after sending the pin mode commands during which
+    # further pin init requests are ignored
+    DEBOUNCE = .02
+
+    def __init__(self, publisher_topic='to_arduino_gateway', subscription_topic='pin_init',
+                 batch=False):
         """
         :param publisher_topic: topic to publish OneGPIO set_pin messages to
 
         :param subscription_topic: topic to subscribe to receive messages
+
+        :param batch: if True, publish all of the set_pin messages as a single
+                      {"commands": [...]} message. The receiving gateway
+                      must support batched commands.
         """
 
         # initialize the parent
@@ -38,44 +52,45 @@ class PinInit(BanyanBase):
 
         self.publisher_topic = publisher_topic
 
-        # subscribe to receive pin init messages
-        self.set_subscriber_topic(subscription_topic)
-
-        # digital output pins to be setup
-        self.digital_output_pins = ({'pin': 9, 'tag': 'blue'},
-                                    {'pin': 10, 'tag': 'green'},
-                                    {'pin': 11, 'tag': 'red'})
+        self.batch = batch
 
-        # command for digital output
-        self.dig_out_command = {"command": "set_mode_digital_output", "pin": "PIN",
-                                "tag": "TAG"}
+        # time that the pin mode commands were last sent
+        self._last_init = float('-inf')
 
-        # pins to be setup for pwm output
-        self.pwm_output_pins = ({'pin': 6, 'tag': 'white'},)
-
-        # command for pwm output
-        self.pwm_out_command = {"command": "set_mode_pwm", "pin": "PIN",
-                                "tag": "TAG"}
-
-        # pins to be setup for analog input
-        self.analog_input_pins = ({'pin': 2, 'tag': 'potentiometer'},)
-
-        # command for analog input
-        self.analog_in_command = {"command": "set_mode_analog_input", "pin": "PIN",
-                               "tag": "TAG"}
-        # pin to be setup for servo mode
-        self.servo_pins = ({'pin': 5, 'tag': 'servo'},)
+        # subscribe to receive pin init messages
+        self.set_subscriber_topic(subscription_topic)
 
-        # command for servo mode
-        self.servo_command = {"command": "set_mode_servo", "pin": "PIN",
-                                "tag": "TAG"}
+        # the pin mode commands in the order they are sent, kept as
+        # parallel tuples of command, pin number and tag
+        self._cmds, self._pins, self._tags = zip(
+            ('set_mode_digital_output', 9, 'blue'),
+            ('set_mode_digital_output', 10, 'green'),
+            ('set_mode_digital_output', 11, 'red'),
+            ('set_mode_pwm', 6, 'white'),
+            ('set_mode_analog_input', 2, 'potentiometer'),
+            ('set_mode_servo', 5, 'servo'))
+
+        # the set_pin messages never change, so they are encoded once here
+        # in the same way as publish_payload encodes them, and published
+        # as raw bytes.
+        # ZMQ_CONFLATE is not set on the publisher: each message sets up a
+        # different pin, so none of them may be dropped, and conflate does
+        # not support Banyan's multipart messages.
+        self._encoded_topic = self.publisher_topic.encode()
+        commands = self.pin_commands()
+        if self.batch:
+            self._encoded_msgs = [msgpack.packb({'commands': commands},
+                                                use_bin_type=True)]
+        else:
+            self._encoded_msgs = [msgpack.packb(command, use_bin_type=True)
+                                  for command in commands]
+
+        # shut down cleanly on SIGINT and SIGTERM
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
 
         # wait for messages to arrive
-        try:
-            self.receive_loop()
-        except KeyboardInterrupt:
-            self.clean_up()
-            sys.exit(0)
+        self.receive_loop()
 
     def incoming_message_processing(self, _topic, _payload):
         """
@@ -84,25 +99,59 @@ class PinInit(BanyanBase):
         :param _payload: message payload
         """
 
+        # a burst of requests only sends the commands once
+        now = time.monotonic()
+        if now - self._last_init < self.DEBOUNCE:
+            return
+        self._last_init = now
+
         # send out mode setting commands
-        self.pin_tag_messages(self.dig_out_command, self.digital_output_pins)
-        self.pin_tag_messages(self.pwm_out_command, self.pwm_output_pins)
-        self.pin_tag_messages(self.analog_in_command, self.analog_input_pins)
-        self.pin_tag_messages(self.servo_command, self.servo_pins)
+        topic = self._encoded_topic
+        publish_raw = self.publish_raw
+        for message in self._encoded_msgs:
+            publish_raw(topic, message)
 
-    def pin_tag_messages(self, command, pins):
-        for pin_tags in pins:
-            try:
-                command['pin'] = pin_tags['pin']
-                command['tag'] = pin_tags['tag']
-            except TypeError:
-                raise
+    def pin_commands(self):
+        """
+        Build a list of set_pin commands
+        :return: a list containing a command for each pin
+        """
+        return [{'command': command, 'pin': pin, 'tag': tag}
+                for command, pin, tag in zip(self._cmds, self._pins, self._tags)]
+
+    def publish_raw(self, topic, message):
+        """
+        Publish an already encoded message
+        :param topic: encoded topic
+        :param message: msgpack encoded message
+        """
+        self.publisher.send_multipart([topic, message])
+
+    def stop(self, _signum, _frame):
+        """
+        Signal handler to clean up and exit
+        """
+        self.clean_up()
+        sys.exit(0)
 
-            self.publish_payload(command, self.publisher_topic)
+    def clean_up(self):
+        """
+        Close the sockets without lingering and terminate the context
+        """
+        self.publisher.close(linger=0)
+        self.subscriber.close(linger=0)
+        self.my_context.term()
 
 
 def pin_init():
-    PinInit()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--batch", dest="batch", default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help="Send all pin mode commands in a single message.")
+
+    args = parser.parse_args()
+
+    PinInit(batch=args.batch)
 
 
 if __name__ == '__main__':
@@ -18,7 +18,13 @@ simple_echo_client.py
 
 """
 
+import argparse
+import collections
+import signal
 import sys
+
+import msgpack
+import zmq
 from python_banyan.banyan_base import BanyanBase
 
 
@@ -28,23 +34,53 @@ class PinInitTester(BanyanBase):
     echo reply from the server.
     """
 
-    def __init__(self):
+    # milliseconds to wait for a reply
+    REPLY_TIMEOUT = 1000
+
+    def __init__(self, wait=False):
+        """
+        :param wait: if True, keep receiving replies until interrupted,
+                     otherwise exit after the first reply or REPLY_TIMEOUT
+        """
+
+        # received messages waiting to be printed
+        self._log_buf = collections.deque(maxlen=4096)
 
         # initialize the parent
-        super(PinInitTester, self).__init__(process_name='EchoClient')
+        super(PinInitTester, self).__init__(process_name='EchoClient',
+                                            receive_loop_idle_addition=self.flush_log)
 
-        # accept banyan messages with the topic of reply
-        self.set_subscriber_topic('set_pin_mode')
+        # accept the pin mode commands that PinInit publishes
+        self.set_subscriber_topic('to_arduino_gateway')
 
         # send the first message - make sure that the server is already started
         self.publish_payload({'init_pins': 0}, 'pin_init')
 
+        # shut down cleanly on SIGINT and SIGTERM
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
         # get the reply messages
-        try:
+        if wait:
             self.receive_loop()
-        except KeyboardInterrupt:
+        else:
+            self.receive_reply()
+
+    def receive_reply(self):
+        """
+        Wait up to REPLY_TIMEOUT milliseconds for a single reply, print it
+        and clean up. Exit with a non-zero status if no reply arrives.
+        """
+        if not self.subscriber.poll(self.REPLY_TIMEOUT):
+            print('No reply received from PinInit.')
             self.clean_up()
-            sys.exit(0)
+            sys.exit(1)
+
+        topic, payload = self.subscriber.recv_multipart(zmq.NOBLOCK)
+        self.incoming_message_processing(topic.decode(),
+                                         msgpack.unpackb(payload, raw=False))
+        self.flush_log()
+        self.clean_up()
 
     def incoming_message_processing(self, topic, payload):
         """
@@ -53,12 +89,46 @@ class PinInitTester(BanyanBase):
         :param payload: Message Data
         """
 
-        # When a message is received and its number is zero, finish up.
-        print(topic, payload)
+        # the message is printed when the receive loop is idle
+        self._log_buf.append((topic, payload))
+
+    def flush_log(self):
+        """
+        Print the buffered messages with a single write
+        """
+        buf = self._log_buf
+        if buf:
+            lines = [f'{topic} {payload}\n' for topic, payload in buf]
+            buf.clear()
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+
+    def stop(self, _signum, _frame):
+        """
+        Signal handler to print any buffered messages, clean up and exit
+        """
+        self.flush_log()
+        self.clean_up()
+        sys.exit(0)
+
+    def clean_up(self):
+        """
+        Close the sockets without lingering and terminate the context
+        """
+        self.publisher.close(linger=0)
+        self.subscriber.close(linger=0)
+        self.my_context.term()
 
 
 def pin_init_tester():
-    PinInitTester()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--wait", dest="wait", default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help="Keep waiting for replies instead of exiting after the first.")
+
+    args = parser.parse_args()
+
+    PinInitTester(wait=args.wait)
 
 
 if __name__ == '__main__':
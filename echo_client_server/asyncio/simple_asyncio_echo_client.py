@@ -18,9 +18,20 @@ simple_asyncio_echo_client.py
 
 """
 import asyncio
+import signal
 import sys
+
+import zmq
 from python_banyan.banyan_base_aio import BanyanBaseAIO
 
+# uvloop is optional - use it if it is installed (not available on Windows)
+try:
+    import uvloop
+    # uvloop.run was added in uvloop 0.18
+    run = getattr(uvloop, 'run', asyncio.run)
+except ImportError:
+    run = asyncio.run
+
 
 class EchoClient(BanyanBaseAIO):
     """
@@ -32,39 +43,75 @@ class EchoClient(BanyanBaseAIO):
     Finrally run the client.
     """
 
-    def __init__(self):
-        self.event_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.event_loop)
+    # number of messages kept in flight to the server
+    WINDOW = 4
 
-        # initialize the parent
-        super(EchoClient, self).__init__(process_name='EchoClient',
-                                         event_loop=self.event_loop)
+    # maximum number of messages received per wakeup of the receive loop
+    MAX_RECV = 64
 
+    def __init__(self):
         # sequence number of messages and total number of messages to send
         self.message_number = self.number_of_messages = 10
 
+        # the outgoing message is reused for every send - see publish_payload
+        self._out_msg = {'message_number': self.number_of_messages}
+
         try:
-            self.event_loop.run_until_complete(self.startup())
+            run(self.startup())
         except KeyboardInterrupt:
             sys.exit(0)
 
     async def startup(self):
         """
-        Kick off the receive loop
+        Initialize the parent on the running event loop and
+        kick off the receive loop
         """
+        super(EchoClient, self).__init__(process_name='EchoClient',
+                                         event_loop=asyncio.get_running_loop())
+
+        # set when the reply to the last message is received,
+        # or when SIGINT or SIGTERM is received
+        self._done = asyncio.Event()
+        if sys.platform != 'win32':
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                self.event_loop.add_signal_handler(sig, self._done.set)
+
+        # begin() also starts the receive loop as a task
         await self.begin()
         # subscribe to receive 'asyncio_echo_client_server' messages from the client
         await self.set_subscriber_topic('reply')
 
-        # send the first message - make sure that the server is already started
-        await self.publish_payload({'message_number': self.message_number}, 'asyncio_echo_client_server')
+        # the topic and publish method are used for every message
+        self._topic_b = b'asyncio_echo_client_server'
+        self._publish = self.publish_payload
 
-        # wait for messages to arrive
-        try:
-            await self.receive_loop()
-        except KeyboardInterrupt:
-            await self.clean_up()
-            sys.exit(0)
+        # send the first messages - make sure that the server is already started
+        for _ in range(min(self.WINDOW, self.number_of_messages + 1)):
+            await self.send_next_message()
+
+        # wait for the last reply to arrive and then shut down
+        await self._done.wait()
+        self.the_task.cancel()
+        await self.clean_up()
+
+    async def receive_loop(self):
+        """
+        Receive loop that processes all of the messages that are already
+        waiting after each wakeup, up to MAX_RECV, before waiting again.
+        """
+        subscriber = self.subscriber
+        unpack = self.unpack
+        incoming_message_processing = self.incoming_message_processing
+        max_recv = self.MAX_RECV
+        while True:
+            await subscriber.poll()
+            for _ in range(max_recv):
+                try:
+                    topic_b, payload_b = await subscriber.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                await incoming_message_processing(topic_b.decode(),
+                                                  await unpack(payload_b))
 
     async def incoming_message_processing(self, topic, payload):
         """
@@ -73,15 +120,58 @@ class EchoClient(BanyanBaseAIO):
         :param payload: Message Data
         """
 
+        message_number = payload['message_number']
+
         # When a message is received and its number is zero, finish up.
-        if payload['message_number'] == 0:
+        if message_number == 0:
             print(str(self.number_of_messages) + ' messages sent and received. ')
-        # bump the message number and send the message out
+            self._done.set()
+        # send the next message out to keep the window full
+        elif self.message_number >= 0:
+            await self.send_next_message()
+
+    async def send_next_message(self):
+        """
+        Send the current message number and bump the message number
+        """
+        message_number = self.message_number
+        self.message_number = message_number - 1
+        out_msg = self._out_msg
+        out_msg['message_number'] = message_number
+        await self._publish(out_msg, self._topic_b)
+
+    async def publish_payload(self, payload, topic=''):
+        """
+        Publish a payload. The topic may also be passed as an already
+        encoded bytes object to skip encoding it on every publish.
+
+        The payload is packed before this method first suspends, so the
+        caller is free to modify and reuse it as soon as the call is made.
+
+        :param payload: Protocol message to be published
+
+        :param topic: A string or bytes value
+        """
+        if type(topic) is not bytes:
+            await super(EchoClient, self).publish_payload(payload, topic)
+            return
+
+        if self.numpy:
+            message = await self.numpy_pack(payload)
         else:
-            self.message_number -= 1
-            if self.message_number >= 0:
-                await self.publish_payload({'message_number': self.message_number},
-                                           'asyncio_echo_client_server')
+            message = await self.pack(payload)
+
+        await self.publisher.send_multipart([topic, message])
+
+    async def clean_up(self):
+        """
+        Close the sockets without lingering and terminate the context.
+        The sockets' close() is not awaitable, so this replaces the
+        parent's clean_up.
+        """
+        self.publisher.close(linger=0)
+        self.subscriber.close(linger=0)
+        self.my_context.term()
 
 
 def echo_client():
@@ -17,10 +17,24 @@ simple_asyncio_echo_server.py
  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 """
+import argparse
 import asyncio
+import collections
+import signal
 import sys
+
+import zmq
+import zmq.asyncio
 from python_banyan.banyan_base_aio import BanyanBaseAIO
 
+# uvloop is optional - use it if it is installed (not available on Windows)
+try:
+    import uvloop
+    # uvloop.run was added in uvloop 0.18
+    run = getattr(uvloop, 'run', asyncio.run)
+except ImportError:
+    run = asyncio.run
+
 
 class EchoServer(BanyanBaseAIO):
     """
@@ -29,49 +43,178 @@ class EchoServer(BanyanBaseAIO):
     To run the client/server demo, start the backplane and a monitor.
     Next, start the server and finally start the client. View the monitor output.
     """
-    def __init__(self):
 
-        self.event_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.event_loop)
+    # maximum number of messages received per wakeup of the receive loop
+    MAX_RECV = 64
+
+    # high water mark of the publisher and subscriber sockets
+    HWM = 64
+
+    # seconds between writes of the debug output
+    LOG_INTERVAL = .05
+
+    # maximum number of debug lines written at once
+    MAX_LOG_LINES = 1024
+
+    def __init__(self, debug=False):
+        """
+        :param debug: print the number of each message received
+        """
+        self.debug = debug
+
+        # received messages waiting to be republished
+        self._out = None
+
+        # debug output waiting to be written. If the output falls behind,
+        # the oldest lines are dropped.
+        self._log_buf = collections.deque(maxlen=4096)
 
-        # initialize the parent
-        super(EchoServer, self).__init__(process_name='EchoServer',
-                                         event_loop=self.event_loop)
         try:
-            self.event_loop.run_until_complete(self.startup())
+            run(self.startup())
         except KeyboardInterrupt:
             sys.exit(0)
 
     async def startup(self):
         """
-        Kick off the receive loop
+        Initialize the parent on the running event loop and
+        kick off the receive loop
         """
+        super(EchoServer, self).__init__(process_name='EchoServer',
+                                         event_loop=asyncio.get_running_loop())
+
+        # begin() creates its sockets from this context. Every echo is
+        # answered, so the socket queues are kept short, and messages are
+        # only queued once the backplane connection is up.
+        self.my_context = zmq.asyncio.Context()
+        self.my_context.sndhwm = self.my_context.rcvhwm = self.HWM
+        self.my_context.immediate = 1
+
+        # SIGINT and SIGTERM set this to shut the server down
+        self._stop_event = asyncio.Event()
+        if sys.platform != 'win32':
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                self.event_loop.add_signal_handler(sig, self._stop_event.set)
+
+        self._out = asyncio.Queue()
+        # begin() also starts the receive loop as a task
         await self.begin()
         # subscribe to receive 'asyncio_echo_client_server' messages from the client
         await self.set_subscriber_topic('asyncio_echo_client_server')
 
-        # wait for messages to arrive
-        try:
-            await self.receive_loop()
-        except KeyboardInterrupt:
-            await self.clean_up()
-            sys.exit(0)
+        # the reply topic and publish method are used for every message
+        self._reply_topic_b = b'reply'
+        self._publish = self.publish_raw
+
+        # start the task that sends out the replies
+        self.event_loop.create_task(self.publish_replies())
+
+        if self.debug:
+            self.event_loop.create_task(self.flush_log())
+
+        # process messages until asked to stop
+        await self._stop_event.wait()
+        self.the_task.cancel()
+        await self.clean_up()
+
+    async def receive_loop(self):
+        """
+        Receive loop that hands the raw message frames to incoming_message_raw.
+        After each wakeup, all of the messages that are already waiting are
+        processed, up to MAX_RECV, before waiting again.
+        """
+        subscriber = self.subscriber
+        incoming_message_raw = self.incoming_message_raw
+        max_recv = self.MAX_RECV
+        while True:
+            await subscriber.poll()
+            for _ in range(max_recv):
+                try:
+                    topic_b, payload_b = await subscriber.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                await incoming_message_raw(topic_b, payload_b)
+
+    async def incoming_message_raw(self, topic_b, payload_b):
+        """
+        Process incoming messages from the client without decoding them.
+        The payload is echoed back exactly as it was received.
+        :param topic_b: encoded message topic
+        :param payload_b: msgpack encoded message payload
+        """
+        # queue the message to be republished with a topic of reply
+        self._out.put_nowait(payload_b)
+
+        # the payload only needs to be decoded to be printed
+        if self.debug:
+            await self.incoming_message_processing(topic_b.decode(),
+                                                   await self.unpack(payload_b))
 
     async def incoming_message_processing(self, _topic, payload):
         """
-        Process incoming messages from the client
+        Print the number of a message received from the client
         :param _topic: message topic
         :param payload: message payload
         """
-        # republish the message with a topic of reply
-        await self.publish_payload(payload, 'reply')
-
         # extract the message number from the payload
-        print('Message number:', payload['message_number'])
+        self._log_buf.append(payload['message_number'])
+
+    async def flush_log(self):
+        """
+        Periodically write out the buffered debug output
+        """
+        buf = self._log_buf
+        interval = self.LOG_INTERVAL
+        max_lines = self.MAX_LOG_LINES
+        stdout = sys.stdout
+        while True:
+            await asyncio.sleep(interval)
+            if buf:
+                lines = [f'Message number: {buf.popleft()}\n'
+                         for _ in range(min(len(buf), max_lines))]
+                stdout.write(''.join(lines))
+                stdout.flush()
+
+    async def publish_replies(self):
+        """
+        Republish the queued messages with a topic of reply.
+        Neither getting a queued message nor a PUB socket send suspends
+        while there is work, so a burst is sent without returning to
+        the event loop.
+        """
+        out = self._out
+        publish = self._publish
+        topic = self._reply_topic_b
+        while True:
+            await publish(topic, await out.get())
+
+    async def publish_raw(self, topic, message):
+        """
+        Publish an already encoded message
+        :param topic: encoded topic
+        :param message: msgpack encoded message
+        """
+        await self.publisher.send_multipart([topic, message])
+
+    async def clean_up(self):
+        """
+        Close the sockets without lingering and terminate the context.
+        The sockets' close() is not awaitable, so this replaces the
+        parent's clean_up.
+        """
+        self.publisher.close(linger=0)
+        self.subscriber.close(linger=0)
+        self.my_context.term()
 
 
 def echo_server():
-    EchoServer()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--debug", dest="debug", default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help="Print the number of each message received.")
+
+    args = parser.parse_args()
+
+    EchoServer(debug=args.debug)
 
 
 if __name__ == '__main__':